@@ -1,15 +1,19 @@
 import os
-import re
-import json
 import time
 import hmac
 import hashlib
+import queue
 import threading
+import functools
+import urllib.parse
 from typing import Tuple
 
-from flask import Flask, request
+import httpx
+import orjson
+from flask import Flask, Response, request
+from werkzeug.exceptions import RequestEntityTooLarge
 from google.auth import default
-from google.auth.transport.requests import AuthorizedSession
+from google.auth.transport.requests import Request as GoogleAuthRequest
 
 app = Flask(__name__)
 
@@ -26,11 +30,32 @@ SLACK_SIGNING_SECRET     = os.getenv("SLACK_SIGNING_SECRET", "")
 SLACK_VERIFICATION_TOKEN = os.getenv("SLACK_VERIFICATION_TOKEN", "")
 
 # オプション（運用ガード）
-ALLOWLIST_PJS = [p.strip() for p in os.getenv("ALLOWLIST_PJS", "").split(",") if p.strip()]
+ALLOWLIST_PJS = frozenset(p.strip() for p in os.getenv("ALLOWLIST_PJS", "").split(",") if p.strip())
 PASSPHRASE    = os.getenv("PASSPHRASE", "").strip()  # 例: ローデータ完了
 # 例: {"pjshin": "ローデータ完了", "pjragnarok": "ready"}
-PASSPHRASE_BY_PJ = json.loads(os.getenv("PASSPHRASE_BY_PJ", "{}") or "{}")
-CHANNEL_ALLOWLIST = [c.strip() for c in os.getenv("CHANNEL_ALLOWLIST", "").split(",") if c.strip()]
+PASSPHRASE_BY_PJ = orjson.loads(os.getenv("PASSPHRASE_BY_PJ", "{}").encode() or b"{}")
+# PJごとの合言葉 > グローバル の解決結果を起動時に作っておく
+_PHRASE_BY_PJ = {pj: (phrase or PASSPHRASE) for pj, phrase in PASSPHRASE_BY_PJ.items()}
+_DEFAULT_PHRASE = PASSPHRASE or None
+CHANNEL_ALLOWLIST = frozenset(c.strip() for c in os.getenv("CHANNEL_ALLOWLIST", "").split(",") if c.strip())
+
+# Cloud Run Job 起動 URL（{pj} だけ残したテンプレートを起動時に組み立てておく）
+_JOB_URL_TMPL = (
+    f"https://{REGION}-run.googleapis.com/apis/run.googleapis.com/v1/"
+    f"namespaces/{PROJECT_ID}/jobs/{JOB_NAME_TEMPLATE}:run"
+)
+
+# _JOB_Q を処理する常駐ワーカースレッドの数（= run_job の最大同時実行数）
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+
+# 署名検証の対象にするボディの上限（Slack のスラッシュコマンドは数KB程度）
+MAX_SLACK_BODY_BYTES = 64 * 1024
+# ボディの読み込み上限は Werkzeug 側で強制する
+# （Content-Length 超過時は get_data が 413 例外、chunked は上限で打ち切られ署名不一致になる）
+app.config["MAX_CONTENT_LENGTH"] = MAX_SLACK_BODY_BYTES
+
+# HMAC 用の鍵はリクエスト毎に encode しないよう起動時に bytes 化しておく
+_SIGNING_SECRET_BYTES = SLACK_SIGNING_SECRET.encode()
 
 # 起動時に致命傷にならないように、未設定は警告ログだけ
 if not PROJECT_ID:
@@ -38,97 +63,176 @@ if not PROJECT_ID:
 if not SLACK_SIGNING_SECRET and not SLACK_VERIFICATION_TOKEN:
     print("[WARN] No Slack auth configured (SIGNING_SECRET or VERIFICATION_TOKEN).")
 
+# pj 名に使える文字（"pj" の後ろ）。正規表現を使わずに判定する
+_PJ_ALLOWED = frozenset("abcdefghijklmnopqrstuvwxyz0123456789")
+# pj 名の最大長（異常に長いトークンを文字チェックや URL 組み立てに回さない）
+_PJ_MAX_LEN = 32
+
+# ジョブ起動キュー（ハンドラは put するだけ。常駐ワーカーが取り出して run_job する）
+_JOB_Q = queue.SimpleQueue()
+
+# Cloud Run API 向けの HTTP/2 クライアント（同時のジョブ起動を 1 接続に多重化する）
+_HTTP = httpx.Client(
+    http2=True,
+    timeout=10.0,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+)
+
+# 認証情報は初回利用時に取得して使い回し、期限切れのときだけ更新する
+_CREDS = None
+_CREDS_LOCK = threading.Lock()
+_AUTH_REQUEST = GoogleAuthRequest()
+
+# 固定の応答文はリクエスト毎に encode しないよう bytes で持っておく
+_TEXT_CONTENT_TYPE = "text/plain; charset=utf-8"
+_MSG_VERIFY_ERROR = "署名検証エラー。Signing Secret と Request URL（/slack）を確認してください。".encode("utf-8")
+_MSG_CH_DENIED    = "このチャンネルでは実行できません。".encode("utf-8")
+_MSG_USAGE        = "使い方: `/gameprm pjshin ローデータ完了`".encode("utf-8")
+_MSG_BAD_REQUEST  = "リクエストを解釈できませんでした。".encode("utf-8")
+_MSG_TOO_LARGE    = "メッセージが長すぎます。テキストを短くして送り直してください。".encode("utf-8")
+
 # =========================
 # ヘルパ関数
 # =========================
+def _text_reply(body, status: int = 200) -> Response:
+    # /slack の応答は固定文（bytes）も動的な文（str）も text/plain に揃える
+    return Response(body, status=status, content_type=_TEXT_CONTENT_TYPE)
+
+
+def parse_form(body: bytes) -> dict:
+    """
+    Slack のボディ（単一値の urlencoded）を dict にする。Werkzeug の form パーサは通さない。
+    ASCII 以外やフィールド数超過は ValueError。
+    """
+    return dict(urllib.parse.parse_qsl(body.decode("ascii"), keep_blank_values=True, max_num_fields=32))
+
+
 def parse_pj_and_text(form) -> Tuple[str, str]:
     """
     /gameprm コマンド前提。
     text は「pj名 残りテキスト」の形式（例: "pjshin ローデータ完了"）
     """
-    command = (form.get("command") or "").strip()
-    if command != "/gameprm":
-        return "", (form.get("text") or "").strip()
-
     text = (form.get("text") or "").strip()
+    if (form.get("command") or "").strip() != "/gameprm":
+        return "", text
     if not text:
         return "", ""
 
-    parts = text.split()
-    pj = parts[0] if parts else ""
-    rest = " ".join(parts[1:]).strip() if len(parts) > 1 else ""
+    # 先頭の pj だけ切り出し、残りは分割しない
+    parts = text.split(None, 1)
+    pj = parts[0]
+    rest = parts[1].strip() if len(parts) > 1 else ""
     # pj は "pj"で始まる英数字（例: pjshin, pjragnarok）
-    if not re.fullmatch(r"pj[a-z0-9]+", pj):
+    if not (3 <= len(pj) <= _PJ_MAX_LEN):
+        return "", text
+    if not (pj.startswith("pj") and all(c in _PJ_ALLOWED for c in pj[2:])):
         return "", text
     return pj, rest
 
 
 def is_channel_allowed(form) -> bool:
-    if not CHANNEL_ALLOWLIST:
-        return True
-    ch = form.get("channel_id")
-    return ch in CHANNEL_ALLOWLIST
+    return not CHANNEL_ALLOWLIST or form.get("channel_id") in CHANNEL_ALLOWLIST
 
 
 def check_passphrase(pj: str, text: str) -> bool:
     # PJごとの合言葉 > グローバル > 未設定（常にOK）
-    phrase = PASSPHRASE_BY_PJ.get(pj) or PASSPHRASE
-    if not phrase:
-        return True
-    return re.search(re.escape(phrase), text) is not None
+    phrase = _PHRASE_BY_PJ.get(pj, _DEFAULT_PHRASE)
+    return not phrase or phrase in text
 
 
 def verify_slack(req):
     """
-    Slack App（Signing Secret）優先で検証。
-    旧Custom Integration（Verification Token）にもフォールバック対応。
+    Slack App（Signing Secret）で検証。
+    旧Custom Integration（Verification Token）は Signing Secret 未設定時のみ使用。
+    どちらもキャッシュ済みのボディ bytes だけを読み、req.form には触れない。
     条件を満たせない場合は例外を投げる（呼び元で握る）。
     """
     # 新方式（Slack App）: 署名ヘッダ検証
     sig = req.headers.get("X-Slack-Signature")
     ts  = req.headers.get("X-Slack-Request-Timestamp")
     if sig and ts and SLACK_SIGNING_SECRET:
-        # リプレイ対策：5分以内
+        # リプレイ対策：5分以内（HMAC 計算より先に安価なチェックで弾く）
+        if not ts.isdigit():
+            raise ValueError("malformed timestamp")
         if abs(time.time() - int(ts)) > 60 * 5:
             raise ValueError("timestamp too old")
-        basestring = f"v0:{ts}:{req.get_data(as_text=True)}"
-        my_sig = "v0=" + hmac.new(SLACK_SIGNING_SECRET.encode(), basestring.encode(), hashlib.sha256).hexdigest()
-        if not hmac.compare_digest(my_sig, sig):
+        # ボディは str に decode せず bytes のまま署名対象にする（get_data はキャッシュされ form パースでも再利用）
+        body = req.get_data(cache=True)
+        basestring = b"v0:" + ts.encode("ascii") + b":" + body
+        mac = hmac.new(_SIGNING_SECRET_BYTES, basestring, hashlib.sha256).digest()
+        # hex 文字列ではなく生の digest 同士で比較する（"v0=" を除いて decode）
+        if not sig.startswith("v0="):
+            raise ValueError("signature mismatch")
+        try:
+            their = bytes.fromhex(sig[3:])
+        except ValueError:
+            raise ValueError("signature mismatch")
+        if not hmac.compare_digest(mac, their):
             raise ValueError("signature mismatch")
         return
 
     # 旧方式（Custom Integration）: Verification Token
-    token = (req.form.get("token") or req.values.get("token") or "").strip()
-    if SLACK_VERIFICATION_TOKEN and token == SLACK_VERIFICATION_TOKEN:
-        return
+    if SLACK_VERIFICATION_TOKEN and not SLACK_SIGNING_SECRET:
+        form = parse_form(req.get_data(cache=True))
+        token = (form.get("token") or req.args.get("token") or "").strip()
+        if token == SLACK_VERIFICATION_TOKEN:
+            return
 
     raise ValueError("no valid slack auth (missing headers or token mismatch)")
 
 
+def _auth_headers(force_refresh: bool = False) -> dict:
+    global _CREDS
+    headers = {"Content-Type": "application/json"}
+    with _CREDS_LOCK:
+        if _CREDS is None:
+            _CREDS, _ = default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+        if force_refresh or not _CREDS.valid:
+            _CREDS.refresh(_AUTH_REQUEST)
+        _CREDS.apply(headers)
+    return headers
+
+
+@functools.lru_cache(maxsize=64)
+def _job_url(pj: str) -> str:
+    # pj は許可リスト等で有限個に絞られるので、組み立て済み URL をキャッシュする
+    return _JOB_URL_TMPL.format(pj=pj)
+
+
 def run_job(pj: str):
     """
     Cloud Run Job を起動。
     """
-    region = REGION
-    project = PROJECT_ID
-    job_name = JOB_NAME_TEMPLATE.format(pj=pj)
-
-    if not project:
+    if not PROJECT_ID:
         print("[ERROR] PROJECT_ID is empty; aborting run_job.")
         return
 
-    url = (
-        f"https://{region}-run.googleapis.com/apis/run.googleapis.com/v1/"
-        f"namespaces/{project}/jobs/{job_name}:run"
-    )
-    creds, _ = default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
-    session = AuthorizedSession(creds)
-    r = session.post(url, json={})
+    url = _job_url(pj)
+    # 空の JSON ボディは固定なので json エンコードを通さずに送る
+    r = _HTTP.post(url, content=b"{}", headers=_auth_headers())
+    if r.status_code == 401:
+        # 期限前に失効したトークンの可能性があるので、1回だけ更新して再送（AuthorizedSession と同じ挙動）
+        r = _HTTP.post(url, content=b"{}", headers=_auth_headers(force_refresh=True))
     print(f"[run_job] POST {url} -> {r.status_code}")
     if r.status_code >= 300:
         print(f"[run_job] Response: {r.text}")
 
 
+def _job_worker():
+    while True:
+        pj = _JOB_Q.get()
+        try:
+            run_job(pj)
+        except Exception as e:
+            print("[run_job] ERROR:", repr(e))
+
+
+# ワーカーは import 時に起動する。gunicorn の各ワーカープロセスで import されることが前提なので、
+# --preload は使わないこと（fork 前に起動したスレッドは子プロセスに引き継がれない）
+for _i in range(JOB_WORKERS):
+    threading.Thread(target=_job_worker, name=f"runjob-{_i}", daemon=True).start()
+
+
 # =========================
 # ルーティング
 # =========================
@@ -137,32 +241,43 @@ def slack_handler():
     # --- 署名検証：失敗しても Slack には200で応答し、dispatch_failedを避ける ---
     try:
         verify_slack(request)
+    except RequestEntityTooLarge as e:
+        # MAX_CONTENT_LENGTH 超過（ボディ読み込み時に送出される）
+        print("SLACK VERIFY ERROR:", repr(e))
+        return _text_reply(_MSG_TOO_LARGE)
     except Exception as e:
         print("SLACK VERIFY ERROR:", repr(e))
         # デバッグ：必要に応じてヘッダ/ボディも記録（過剰ログに注意）
         # print("Headers:", {k: v for k, v in request.headers.items() if k.startswith("X-Slack")})
         # print("Body:", request.get_data(as_text=True)[:500])
-        return "署名検証エラー。Signing Secret と Request URL（/slack）を確認してください。", 200
+        return _text_reply(_MSG_VERIFY_ERROR)
+
+    # verify_slack が読んだボディ（キャッシュ済み）をそのまま dict にする
+    try:
+        form = parse_form(request.get_data(cache=True))
+    except ValueError:  # UnicodeDecodeError / フィールド数超過
+        return _text_reply(_MSG_BAD_REQUEST)
 
     # --- チャンネル制限（任意） ---
-    if not is_channel_allowed(request.form):
-        return "このチャンネルでは実行できません。", 200
+    if not is_channel_allowed(form):
+        return _text_reply(_MSG_CH_DENIED)
 
     # --- 入力パース ---
-    pj, rest = parse_pj_and_text(request.form)
+    pj, rest = parse_pj_and_text(form)
     if not pj:
-        return "使い方: `/gameprm pjshin ローデータ完了`", 200
+        return _text_reply(_MSG_USAGE)
 
     if ALLOWLIST_PJS and pj not in ALLOWLIST_PJS:
-        return f"許可されていない pj です: `{pj}`", 200
+        return _text_reply(f"許可されていない pj です: `{pj}`")
 
     if not check_passphrase(pj, rest):
-        phrase = PASSPHRASE_BY_PJ.get(pj) or PASSPHRASE or "（未設定）"
-        return f"愛言葉が違います。`{phrase}` を含めて送ってください。", 200
+        phrase = _PHRASE_BY_PJ.get(pj, _DEFAULT_PHRASE) or "（未設定）"
+        return _text_reply(f"愛言葉が違います。`{phrase}` を含めて送ってください。")
 
     # --- 即時ACKし、裏でジョブ起動（3秒ルール対策） ---
-    threading.Thread(target=run_job, args=(pj,), daemon=True).start()
-    return f"✅ `{pj}` のジョブ起動リクエストを受け付けました。数分後に結果がSlackへ投稿されます。", 200
+    ack = f"✅ `{pj}` のジョブ起動リクエストを受け付けました。数分後に結果がSlackへ投稿されます。"
+    _JOB_Q.put(pj)
+    return _text_reply(ack)
 
 
 @app.route("/")
@@ -171,5 +286,7 @@ def health():
 
 
 if __name__ == "__main__":
-    # Cloud Run 環境では gunicorn 等から呼ばれる想定だが、ローカル動作用に記載
+    # 本番は `gunicorn -c gunicorn_conf.py app:app` で起動する。開発サーバはローカル用（FLASK_DEV=1 のときのみ）
+    if os.getenv("FLASK_DEV") != "1":
+        raise SystemExit("Use `gunicorn -c gunicorn_conf.py app:app` (set FLASK_DEV=1 for the dev server).")
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", "8080")))
@@ -0,0 +1,12 @@
+import os
+
+# Cloud Run 用の gunicorn 設定
+# 1 プロセス + スレッドで並行処理（run_job のプールや HTTP セッションをプロセス内で共有するため）
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = 1
+# app.py は import 時にジョブワーカースレッドを起動するので preload しない
+preload_app = False
+worker_class = "gthread"
+threads = int(os.getenv("THREADS", "16"))
+keepalive = 75
+timeout = 10